@@ -1,10 +1,14 @@
 #!/usr/bin/python3
 import os
+import time
+from threading import Thread
 
 import requests
 from flask import Flask, Response, render_template, jsonify, request
 
 import utils
+import stack_sampler
+import jpeg_encoder
 from video_reader import VideoWorker
 from inference import InferenceWorker
 
@@ -14,6 +18,13 @@ SERVER_ADDR = "10.28.140.146"
 SERVER_PROTOCOL = 'http'
 SERVER_URL = SERVER_PROTOCOL + '://' + SERVER_ADDR
 
+# Maximum seconds to wait for each worker thread to stop when tearing down in the background
+worker_join_timeout = 5.0
+
+# The stack sampling profiler route is only registered when enabled, by starting the
+# client with SMARTPROCTOR_PROFILER=1
+PROFILER_ENABLED = os.environ.get('SMARTPROCTOR_PROFILER') == '1'
+
 
 class SmartProctorApp:
     """ The interface of the SmartProctor edge computing client, enabling the web client to
@@ -22,6 +33,7 @@ class SmartProctorApp:
         self.exam_id = 0
         self.video_worker = VideoWorker()
         self.inference_worker = None
+        self.stopping_inference_worker = None
         self.app = Flask("smartproctor-cam")
         self.app.add_url_rule('/sn', 'sn', self.get_serial, methods=['GET'])
         self.app.add_url_rule("/login_and_start_exam", 'login_and_start_exam', self.login_and_start_exam, methods=['POST'])
@@ -30,6 +42,8 @@ class SmartProctorApp:
         self.app.add_url_rule('/connect_wifi', 'connect_wifi', self.connect_wifi, methods=['POST'])
         self.app.add_url_rule('/wifi_ssids', 'wifi_ssids', self.ssids, methods=['GET'])
         self.app.add_url_rule('/video_stream', 'video_stream', self.video_stream, methods=['GET'])
+        if PROFILER_ENABLED:
+            self.app.add_url_rule('/debug/profile', 'profile', self.profile, methods=['GET'])
         self.app.after_request(self.add_cors_header)
 
     def run_server(self, port=8080):
@@ -59,6 +73,19 @@ class SmartProctorApp:
         """ Get current network status, with IP address """
         return jsonify(utils.get_network_status())
 
+    def profile(self):
+        """ Samples the stacks of all threads for a duration, returns collapsed stacks that
+         can be rendered as a flamegraph """
+        duration = request.args.get('duration', 5, type=float)
+        interval = request.args.get('interval', 0.01, type=float)
+        try:
+            samples = stack_sampler.sample_stacks(duration, interval)
+        except stack_sampler.SamplerBusy:
+            return Response('A profiling session is already running\n', status=409, mimetype='text/plain')
+        except ValueError as ex:
+            return Response(str(ex) + '\n', status=400, mimetype='text/plain')
+        return Response(stack_sampler.collapse(samples), mimetype='text/plain')
+
     def login_and_start_exam(self):
         """ Logs in to the SmartProctor's server and begin the exam """
         try:
@@ -68,9 +95,10 @@ class SmartProctorApp:
             o = res.json()
             if o['code'] == 0:
                 self.exam_id = params['examId']
-                # Stop the inference worker thread if running
-                if self.inference_worker is not None and self.inference_worker.is_alive():
-                    self.inference_worker.join()
+                # Stop the inference worker thread if running, two workers must not load the
+                # model or report events at the same time
+                if not self.__wait_inference_stopped():
+                    return jsonify({"success": False})
 
                 # Start the video worker thread if not started
                 if self.video_worker is None or not self.video_worker.is_alive():
@@ -91,15 +119,40 @@ class SmartProctorApp:
 
     def stop_exam(self):
         """ Stop the exam, stop the worker therads """
-        if self.video_worker is not None and self.video_worker.is_alive():
-            self.video_worker.join()
-        if self.inference_worker is not None and self.inference_worker.is_alive():
-            self.inference_worker.join()
-
+        self.__stop_workers_async(self.video_worker, self.inference_worker)
+        if self.inference_worker is not None:
+            self.stopping_inference_worker = self.inference_worker
         self.video_worker = None
         self.inference_worker = None
         return jsonify({'success': True})
 
+    def __wait_inference_stopped(self):
+        """ Stops the running inference worker and waits for it, and for one still stopping
+            after stop_exam, to exit. False if they did not exit within worker_join_timeout """
+        deadline = time.monotonic() + worker_join_timeout
+        for worker in (self.inference_worker, self.stopping_inference_worker):
+            if worker is not None and worker.is_alive():
+                worker.join(max(deadline - time.monotonic(), 0))
+                if worker.is_alive():
+                    return False
+        self.inference_worker = None
+        self.stopping_inference_worker = None
+        return True
+
+    def __stop_workers_async(self, *workers):
+        """ Signals the worker threads to stop and joins them in the background, so the
+            request does not wait for the camera and the model to be released """
+        workers = [worker for worker in workers if worker is not None and worker.is_alive()]
+        for worker in workers:
+            worker.stop_request.set()
+        if len(workers) > 0:
+            Thread(target=self.__join_workers, args=(workers,), daemon=True).start()
+
+    @staticmethod
+    def __join_workers(workers):
+        for worker in workers:
+            worker.join(worker_join_timeout)
+
     def __gen_video_stream(self):
         while True:
             # Gets the camera frames from the video worker
@@ -122,5 +175,7 @@ class SmartProctorApp:
 if __name__ == '__main__':
     # Allows the port used by the server
     os.system("iptables -A INPUT -p tcp --dport 8080 -j ACCEPT")
+    # Select the JPEG encoder backend before serving, the self-benchmark takes a moment
+    jpeg_encoder.get_encoder()
     app = SmartProctorApp()
     app.run_server()
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+""" Microbenchmarks of the detection hot path, run with seeded synthetic frames and detections
+    and with awscam and the SmartProctor server stubbed, so they run on any machine.
+
+    python3 benchmark.py --save          # record the baseline
+    python3 benchmark.py                 # compare against the baseline
+"""
+import argparse
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from load_test import install_fake_awscam, synthetic_frame
+
+# Benchmark configurations
+min_time = 0.5
+repeat = 3
+alloc_rounds = 20
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+seed = 0
+results_per_run = 64
+objects_per_result = 20
+
+
+class StubResponse:
+    def json(self):
+        return {'fileName': 'detection.jpg', 'code': 0}
+
+
+class StubSession:
+    """ Stand-in for the requests session of EventAggregator """
+    headers = {}
+
+    def post(self, *args, **kwargs):
+        return StubResponse()
+
+
+def synthetic_results(model_type, count=results_per_run, objects=objects_per_result):
+    """ Seeded parsed inference results, mostly low confidence detections like the SSD model
+        returns, with a person in every frame
+    """
+    rs = np.random.RandomState(seed)
+    labels = [1, 1, 1, 62, 72, 73, 77, 84]
+    results = []
+    for _ in range(count):
+        result = [{'label': 1, 'prob': 0.9, 'xmin': 100.0, 'ymin': 40.0, 'xmax': 200.0, 'ymax': 290.0}]
+        for _ in range(objects - 1):
+            xmin, ymin = rs.uniform(0, 250, 2)
+            result.append({'label': int(rs.choice(labels)), 'prob': float(rs.beta(1, 4)),
+                           'xmin': float(xmin), 'ymin': float(ymin),
+                           'xmax': float(xmin + rs.uniform(10, 50)), 'ymax': float(ymin + rs.uniform(10, 50))})
+        results.append({model_type: result})
+    return results
+
+
+def setup_benchmarks():
+    """ Gets a dictionary of benchmark names to functions running one operation """
+    install_fake_awscam()
+    import app
+    import inference
+    import video_reader
+    from detection_log import DetectionRecorder
+
+    inference.detection_log_dir = None
+    camera_frame = synthetic_frame(video_reader.original_resolution)
+    stream_frame = synthetic_frame(video_reader.stream_resolution)
+    benchmarks = {}
+
+    # Rule evaluation of one frame with the detection log, events are suppressed by the
+    # cooldown after the first
+    worker = inference.InferenceWorker(1, False, 'auth=benchmark')
+    worker.events.session = StubSession()
+    log_dir = tempfile.mkdtemp(prefix='smartproctor-benchmark-')
+    worker.recorder = DetectionRecorder(log_dir, 'benchmark')
+    atexit.register(shutil.rmtree, log_dir, True)
+    atexit.register(worker.recorder.close)
+    worker.xscale = float(camera_frame.shape[1]) / inference.input_width
+    worker.yscale = float(camera_frame.shape[0]) / inference.input_height
+    results = synthetic_results(inference.model_type)
+    index = [0]
+
+    def process_result():
+        worker.process_result(results[index[0] % len(results)], camera_frame)
+        index[0] += 1
+    benchmarks['process_result'] = process_result
+
+    events = [('cellphone detected', [(120, 220, 300, 420, 0.35)]),
+              ('multiple people detected', [(100, 700, 40, 1000, 0.91), (900, 1500, 60, 1050, 0.84)])]
+    # The worker marks the camera frame in place, drawing over the same frame costs the same
+    marked_frame = camera_frame.copy()
+    benchmarks['mark_frame'] = lambda: worker.mark_frame(marked_frame, events)
+
+    import cv2
+    benchmarks['resize_1080p_300'] = lambda: cv2.resize(camera_frame, (inference.input_height, inference.input_width))
+
+    video_worker = video_reader.VideoWorker()
+    jpeg = video_worker.encoder.encode(stream_frame, video_reader.stream_jpeg_quality)
+
+    def get_frame():
+        video_worker.frame_queue.put_nowait(jpeg)
+        return video_worker.get_frame()
+    benchmarks['get_frame'] = get_frame
+
+    def get_frame_fallback():
+        # The queue stays empty, so every call returns the black placeholder
+        stream_timeout = video_reader.stream_timeout
+        video_reader.stream_timeout = 0
+        try:
+            return video_worker.get_frame()
+        finally:
+            video_reader.stream_timeout = stream_timeout
+    benchmarks['get_frame_fallback'] = get_frame_fallback
+
+    smartproctor = app.SmartProctorApp()
+    smartproctor.video_worker = video_worker
+    stream = smartproctor._SmartProctorApp__gen_video_stream()
+
+    def mjpeg_part():
+        video_worker.frame_queue.put_nowait(jpeg)
+        return next(stream)
+    benchmarks['mjpeg_part'] = mjpeg_part
+    return benchmarks
+
+
+def time_ops(op):
+    """ Gets the best ops/sec over repeat runs of at least min_time seconds """
+    op()
+    best = 0
+    for _ in range(repeat):
+        ops = 0
+        start = time.perf_counter()
+        elapsed = 0
+        while elapsed < min_time:
+            for _ in range(10):
+                op()
+            ops += 10
+            elapsed = time.perf_counter() - start
+        best = max(best, ops / elapsed)
+    return best
+
+
+def measure_allocations(op):
+    """ Gets the peak traced memory of one operation and the memory blocks allocated per
+        operation that are live when it returns, including its result, numpy buffers are
+        traced as well. The blocks are counted per allocation site, so a block freed at one
+        site does not cancel one allocated at another. Temporaries freed within the operation
+        only show in the peak.
+    """
+    op()
+    # Leave out the snapshots themselves
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    tracemalloc.start()
+    try:
+        peak = 0
+        allocated = 0
+        for _ in range(alloc_rounds):
+            before = tracemalloc.take_snapshot().filter_traces(filters)
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            result = op()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+            after = tracemalloc.take_snapshot().filter_traces(filters)
+            del result
+            allocated += sum(stat.count_diff for stat in after.compare_to(before, 'traceback') if stat.count_diff > 0)
+    finally:
+        tracemalloc.stop()
+    return peak, allocated / alloc_rounds
+
+
+def run_benchmarks(names=None):
+    results = {}
+    for name, op in setup_benchmarks().items():
+        if names and name not in names:
+            continue
+        ops = time_ops(op)
+        peak, allocated = measure_allocations(op)
+        results[name] = {'ops_per_sec': ops, 'peak_alloc_bytes': peak, 'alloc_blocks_per_op': allocated}
+    return results
+
+
+def report(results, baseline):
+    print('{:<20} {:>12} {:>10} {:>14} {:>10}'.format('benchmark', 'ops/sec', 'vs base', 'peak alloc B', 'blocks/op'))
+    for name, result in results.items():
+        change = ''
+        if baseline is not None and name in baseline:
+            change = '{:+.1f}%'.format((result['ops_per_sec'] / baseline[name]['ops_per_sec'] - 1) * 100)
+        print('{:<20} {:>12.1f} {:>10} {:>14d} {:>10.2f}'.format(
+            name, result['ops_per_sec'], change, result['peak_alloc_bytes'], result['alloc_blocks_per_op']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all if not given')
+    parser.add_argument('--baseline', default=baseline_path, help='baseline file')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.names)
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+
+    document = {'time': time.time(), 'results': results}
+    if args.save:
+        # Benchmarks not run this time keep their previous baseline
+        saved = dict(baseline or {})
+        saved.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'time': time.time(), 'results': saved}, f, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
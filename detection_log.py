@@ -0,0 +1,224 @@
+import glob
+import os
+import time
+
+import numpy as np
+
+# Each log file starts with a fixed size header followed by fixed size records.
+# Every inferred frame writes at least one record, frames without any detections
+# write a single record with NO_DETECTION_LABEL so they can still be told apart
+# from frames that were never inferred.
+LOG_MAGIC = b'SPDETLOG'
+LOG_VERSION = 1
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('itemsize', '<u4')])
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('frame', '<u4'),
+    ('label', '<u2'),
+    ('prob', '<f4'),
+    ('xmin', '<i2'),
+    ('ymin', '<i2'),
+    ('xmax', '<i2'),
+    ('ymax', '<i2'),
+])
+NO_DETECTION_LABEL = 0
+LOG_EXTENSION = '.dlog'
+
+# Records are buffered in memory and written out in chunks, a file is rotated
+# once it holds max_records_per_file records and only the newest max_files
+# files in the log directory are kept, across all the exams logged there
+flush_records = 1024
+max_records_per_file = 1 << 20
+max_files = 64
+
+
+class DetectionRecorder:
+    """ Appends the raw per-frame detections of the model to rotating binary log files """
+    def __init__(self, directory, prefix, flush_size=flush_records,
+                 file_records=max_records_per_file, file_limit=max_files):
+        self.directory = directory
+        self.prefix = prefix
+        self.flush_size = flush_size
+        self.file_records = file_records
+        self.file_limit = file_limit
+        self.buffer = np.zeros(flush_size, RECORD_DTYPE)
+        self.buffered = 0
+        self.frame = 0
+        self.file = None
+        self.file_written = 0
+        self.file_seq = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, objects, xscale, yscale, timestamp=None):
+        """ Records the detections of one frame
+            objects - Detections parsed by awscam.Model.parseResult
+            xscale, yscale - Scales from the model input to the full resolution frame
+            timestamp - Time of the frame, the current time if not supplied
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if len(objects) == 0:
+            self.__append(timestamp, NO_DETECTION_LABEL, 0.0, 0, 0, 0, 0)
+        for obj in objects:
+            self.__append(timestamp, obj['label'], obj['prob'],
+                          int(xscale * obj['xmin']), int(yscale * obj['ymin']),
+                          int(xscale * obj['xmax']), int(yscale * obj['ymax']))
+        self.frame += 1
+
+    def __append(self, timestamp, label, prob, xmin, ymin, xmax, ymax):
+        if self.buffered == self.flush_size:
+            self.flush()
+        self.buffer[self.buffered] = (timestamp, self.frame, label, prob, xmin, ymin, xmax, ymax)
+        self.buffered += 1
+
+    def flush(self):
+        """ Writes the buffered records to the current log file, rotating it when full """
+        start = 0
+        while start < self.buffered:
+            if self.file is None or self.file_written == self.file_records:
+                self.__rotate()
+            count = min(self.buffered - start, self.file_records - self.file_written)
+            self.file.write(self.buffer[start:start + count].tobytes())
+            self.file_written += count
+            start += count
+        if self.file is not None:
+            self.file.flush()
+        self.buffered = 0
+
+    def __rotate(self):
+        if self.file is not None:
+            self.file.close()
+        while True:
+            name = '{}-{}-{:04d}{}'.format(self.prefix, time.strftime('%Y%m%d-%H%M%S'), self.file_seq, LOG_EXTENSION)
+            self.file_seq += 1
+            try:
+                # Another recorder of the same exam may have started within the same second
+                self.file = open(os.path.join(self.directory, name), 'xb')
+                break
+            except FileExistsError:
+                continue
+        self.file.write(np.array((LOG_MAGIC, LOG_VERSION, RECORD_DTYPE.itemsize), HEADER_DTYPE).tobytes())
+        self.file_written = 0
+        # Remove the oldest files in the directory beyond the limit, bounding the disk use
+        for path in log_files(self.directory)[:-self.file_limit]:
+            os.remove(path)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def log_files(directory, prefix='*'):
+    """ Gets the log files in the directory, least recently written first """
+    paths = glob.glob(os.path.join(directory, prefix + '-*' + LOG_EXTENSION))
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+
+def log_prefix(path):
+    """ Gets the prefix of a log file, the part of its name identifying the recording """
+    return os.path.basename(path).rsplit('-', 3)[0]
+
+
+def log_prefixes(directory):
+    """ Gets the prefixes of the recordings logged in the directory """
+    return sorted(set(log_prefix(path) for path in log_files(directory)))
+
+
+def open_log_file(path):
+    """ Memory-maps the records of a log file, without reading them """
+    header = np.fromfile(path, HEADER_DTYPE, count=1)
+    if len(header) != 1 or header[0]['magic'] != LOG_MAGIC:
+        raise ValueError('Not a detection log: ' + path)
+    if header[0]['version'] != LOG_VERSION or header[0]['itemsize'] != RECORD_DTYPE.itemsize:
+        raise ValueError('Unsupported detection log version: ' + path)
+    if os.path.getsize(path) == HEADER_DTYPE.itemsize:
+        return np.zeros(0, RECORD_DTYPE)
+    # Ignore a partially written trailing record
+    count = (os.path.getsize(path) - HEADER_DTYPE.itemsize) // RECORD_DTYPE.itemsize
+    return np.memmap(path, RECORD_DTYPE, mode='r', offset=HEADER_DTYPE.itemsize, shape=(count,))
+
+
+class DetectionLog:
+    """ Read-only view over the files of a detection log. The files are memory-mapped,
+        so opening hours of recordings is instant and only the slices used are read.
+    """
+    def __init__(self, paths, prefix='*'):
+        """ paths - A log directory, a single log file, or a list of log files
+            prefix - Only open the files of this recording when paths is a directory
+        """
+        if isinstance(paths, str):
+            paths = log_files(paths, prefix) if os.path.isdir(paths) else [paths]
+        parts = [(open_log_file(path), path) for path in paths]
+        # Order by the first record rather than by name, a directory may hold several exams
+        parts = sorted([part for part in parts if len(part[0]) > 0], key=lambda part: part[0][0]['timestamp'])
+        self.paths = [path for _, path in parts]
+        self.parts = [part for part, _ in parts]
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def records(self):
+        """ Gets all the records as one array, this copies the whole log into memory """
+        if len(self.parts) == 0:
+            return np.zeros(0, RECORD_DTYPE)
+        return np.concatenate(self.parts)
+
+    def between(self, start, end):
+        """ Gets the records with start <= timestamp < end """
+        slices = []
+        for part in self.parts:
+            if part[-1]['timestamp'] < start or part[0]['timestamp'] >= end:
+                continue
+            timestamps = part['timestamp']
+            lo = np.searchsorted(timestamps, start, side='left')
+            hi = np.searchsorted(timestamps, end, side='left')
+            slices.append(part[lo:hi])
+        if len(slices) == 0:
+            return np.zeros(0, RECORD_DTYPE)
+        return np.concatenate(slices)
+
+    def time_range(self):
+        """ Gets the (first, last) timestamp of the log, None if empty """
+        if len(self.parts) == 0:
+            return None
+        return (min(float(part[0]['timestamp']) for part in self.parts),
+                max(float(part[-1]['timestamp']) for part in self.parts))
+
+
+def frame_starts(records):
+    """ Gets a mask of the records starting a new frame. The frame counter restarts with
+        every recorder, so a frame starts wherever the counter changes.
+    """
+    return np.concatenate(([True], records['frame'][1:] != records['frame'][:-1]))
+
+
+def split_frames(records):
+    """ Splits the records into per-frame arrays, dropping the no detection markers """
+    if len(records) == 0:
+        return []
+    boundaries = np.flatnonzero(np.diff(records['frame'])) + 1
+    return [frame[frame['label'] != NO_DETECTION_LABEL] for frame in np.split(records, boundaries)]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarizes a detection log')
+    parser.add_argument('path', help='log directory or file')
+    parser.add_argument('--prefix', default='*', help='only summarize this recording of a log directory, e.g. exam12')
+    parser.add_argument('--start', type=float, default=0.0, help='start timestamp')
+    parser.add_argument('--end', type=float, default=float('inf'), help='end timestamp')
+    parser.add_argument('--min-prob', type=float, default=0.0, help='ignore detections below this probability')
+    args = parser.parse_args()
+
+    log = DetectionLog(args.path, args.prefix)
+    records = log.between(args.start, args.end)
+    print('{} files, {} records, time range {}'.format(len(log.paths), len(log), log.time_range()))
+    if len(records) > 0:
+        print('{} frames between {:.3f} and {:.3f}'.format(
+            np.count_nonzero(frame_starts(records)), records[0]['timestamp'], records[-1]['timestamp']))
+        detections = records[(records['label'] != NO_DETECTION_LABEL) & (records['prob'] >= args.min_prob)]
+        labels, counts = np.unique(detections['label'], return_counts=True)
+        for label, count in zip(labels, counts):
+            print('label {:3d}: {} detections'.format(label, count))
@@ -0,0 +1,114 @@
+""" The cheating detection rules of SmartProctor. InferenceWorker evaluates them frame by
+    frame on the device, evaluate_rules evaluates them over recorded detections at once.
+"""
+import numpy as np
+
+# The model used in the project is pre-trained with the COCO dataset
+# The labels in the COCO dataset can be found in
+# https://github.com/ActiveState/gococo/blob/master/labels.txt
+PERSON_LABEL = 1
+TV_LABEL = 72
+LAPTOP_LABEL = 73
+CELLPHONE_LABEL = 77
+BOOK_LABEL = 84
+
+# We have different threshold for different objects since the
+# model's accuracy varies with the object detected
+PERSON_THRESHOLD = 0.5
+TV_LAPTOP_THRESHOLD = 0.5
+CELLPHONE_THRESHOLD = 0.1
+BOOK_THRESHOLD = 0.4
+
+# Errors could occur during detection, but normally they will not occur in many continuous frames
+# We count the occurrences of different situations and detect whether the count exceeds a threshold
+# Also, the number of frames where the previously detected situation discontinues, when the count exceeds
+# a limit, we regard the previous situation as ended
+no_person_max = 10
+no_person_discontinue_max = 10
+multi_person_max = 20
+multi_person_discontinue_max = 20
+multi_monitor_max = 10
+multi_monitor_discontinue_max = 10
+cellphone_max = 3
+cellphone_discontinue_max = 10
+book_max = 3
+book_discontinue_max = 10
+
+# Rule name, event message, labels counted, threshold parameter and the condition on the
+# number of detections above the threshold in a frame
+RULES = (
+    ('no_person', 'Exam taker left', (PERSON_LABEL,), 'person_threshold', lambda n: n < 1),
+    ('multi_person', 'multiple people detected', (PERSON_LABEL,), 'person_threshold', lambda n: n > 1),
+    ('multi_monitor', 'multiple PC monitors/laptops detected', (TV_LABEL, LAPTOP_LABEL),
+     'tv_laptop_threshold', lambda n: n > 1),
+    ('cellphone', 'cellphone detected', (CELLPHONE_LABEL,), 'cellphone_threshold', lambda n: n > 0),
+    ('book', 'book detected', (BOOK_LABEL,), 'book_threshold', lambda n: n > 1),
+)
+
+
+def default_params():
+    """ Gets the rule parameters currently configured in this module """
+    return {
+        'person_threshold': PERSON_THRESHOLD,
+        'tv_laptop_threshold': TV_LAPTOP_THRESHOLD,
+        'cellphone_threshold': CELLPHONE_THRESHOLD,
+        'book_threshold': BOOK_THRESHOLD,
+        'no_person_max': no_person_max,
+        'no_person_discontinue_max': no_person_discontinue_max,
+        'multi_person_max': multi_person_max,
+        'multi_person_discontinue_max': multi_person_discontinue_max,
+        'multi_monitor_max': multi_monitor_max,
+        'multi_monitor_discontinue_max': multi_monitor_discontinue_max,
+        'cellphone_max': cellphone_max,
+        'cellphone_discontinue_max': cellphone_discontinue_max,
+        'book_max': book_max,
+        'book_discontinue_max': book_discontinue_max,
+        'allow_books': False,
+    }
+
+
+def frame_counts(frame_ids, labels, probs, n_frames, rule_labels, threshold):
+    """ Counts the detections of the labels above the threshold in every frame
+        frame_ids - Frame index of every detection, from 0 to n_frames - 1
+        labels, probs - Label and probability of every detection
+    """
+    mask = np.isin(labels, rule_labels) & (probs > threshold)
+    return np.bincount(frame_ids[mask], minlength=n_frames)
+
+
+def evaluate_rule(condition, max_count, discontinue_max):
+    """ Gets the indices of the frames where the rule fires, equivalent to running the
+        counters of InferenceWorker.process_result over every frame.
+        condition - Boolean array, whether the situation is detected in each frame
+    """
+    detected = np.flatnonzero(condition)
+    if len(detected) == 0 or max_count < 1:
+        return detected[:0]
+    # A situation ends once it is not detected in discontinue_max consecutive frames,
+    # so a gap that long between two detections starts a new situation
+    starts = np.concatenate(([True], np.diff(detected) - 1 >= discontinue_max))
+    start_positions = np.flatnonzero(starts)
+    situation = np.cumsum(starts) - 1
+    # The rule fires on the max_count-th detection of each situation
+    occurrence = np.arange(len(detected)) - start_positions[situation]
+    return detected[occurrence == max_count - 1]
+
+
+def evaluate_rules(frame_ids, labels, probs, n_frames, params, count_cache=None):
+    """ Evaluates all the rules over recorded detections, returns a dictionary of rule
+        names to the indices of the frames where the rule fires.
+        count_cache - Optional dictionary reused between calls to skip recounting
+                      detections for thresholds already seen
+    """
+    if count_cache is None:
+        count_cache = {}
+    fired = {}
+    for name, message, rule_labels, threshold_param, condition in RULES:
+        key = (rule_labels, params[threshold_param])
+        if key not in count_cache:
+            count_cache[key] = frame_counts(frame_ids, labels, probs, n_frames, rule_labels, params[threshold_param])
+        detected = condition(count_cache[key])
+        if name == 'book' and params['allow_books']:
+            detected = np.zeros(n_frames, bool)
+        fired[name] = evaluate_rule(detected, params[name + '_max'], params[name + '_discontinue_max'])
+    return fired
@@ -0,0 +1,202 @@
+import errno
+import fcntl
+import os
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Thread, Event, Lock, Condition
+
+import cv2
+
+import jpeg_encoder
+
+# Debug display configurations
+display_max_fps = 10
+display_jpeg_quality = jpeg_encoder.default_quality
+fifo_path = '/tmp/results.mjpeg'
+preview_port = 8081
+idle_timeout = 0.5
+
+# List of valid resolutions
+RESOLUTION = {'1080p': (1920, 1080), '720p': (1280, 720), '480p': (858, 480)}
+
+
+class DisplaySink(Thread):
+    """ Debug display of inference results. The frames handed over by the inference thread
+        are resized, encoded and written to the outputs on this thread, only when a new frame
+        arrives and at most max_fps times per second. Frames arriving faster are dropped,
+        so a slow consumer never holds up the inference thread.
+    """
+    def __init__(self, resolution, outputs, max_fps=display_max_fps, quality=display_jpeg_quality):
+        """ resolution - Desired resolution of the project stream
+            outputs - List of outputs the encoded frames are written to, e.g. FifoOutput
+            max_fps - Maximum number of frames written per second
+            quality - JPEG quality of the frames
+        """
+        super().__init__(daemon=True)
+        if resolution not in RESOLUTION:
+            raise Exception("Invalid resolution")
+        self.resolution = RESOLUTION[resolution]
+        self.outputs = outputs
+        self.interval = 1.0 / max_fps
+        self.quality = quality
+        self.encoder = jpeg_encoder.get_encoder()
+        # Only this thread encodes and the outputs are done with a frame when write returns,
+        # so one buffer is reused for every frame
+        self.buffer = jpeg_encoder.JpegBuffer()
+        self.frame = None
+        self.frame_lock = Lock()
+        self.new_frame = Event()
+        self.stop_request = Event()
+        self.frames_received = 0
+        self.frames_written = 0
+
+    def set_frame_data(self, frame):
+        """ Hands over the next frame, this only stores a reference to it.
+            frame - Numpy array containing the image data of the next frame
+                    in the project stream, it must not be modified afterwards.
+        """
+        with self.frame_lock:
+            self.frame = frame
+            self.frames_received += 1
+        self.new_frame.set()
+
+    def run(self):
+        for output in self.outputs:
+            output.open()
+        last_write = 0
+        while not self.stop_request.isSet():
+            if not self.new_frame.wait(idle_timeout):
+                continue
+            # Cap the frame rate, frames arriving meanwhile replace the pending one
+            delay = last_write + self.interval - time.monotonic()
+            if delay > 0 and self.stop_request.wait(delay):
+                break
+            with self.frame_lock:
+                frame = self.frame
+                self.frame = None
+                self.new_frame.clear()
+            if frame is None:
+                continue
+            last_write = time.monotonic()
+            jpeg = self.encoder.encode(cv2.resize(frame, self.resolution), self.quality, out=self.buffer)
+            for output in self.outputs:
+                output.write(jpeg)
+            self.frames_written += 1
+        for output in self.outputs:
+            output.close()
+
+    def join(self, timeout=None):
+        self.stop_request.set()
+        self.new_frame.set()
+        super().join(timeout)
+
+
+class FifoOutput:
+    """ Writes the frames into a FIFO located in the tmp directory (which lambda has access
+        to). The results can be rendered using mplayer by typing:
+        mplayer -demuxer lavf -lavfdopts format=mjpeg:probesize=32 /tmp/results.mjpeg
+        Frames are skipped while no consumer has the FIFO open.
+    """
+    def __init__(self, path=fifo_path):
+        self.path = path
+        self.file = None
+
+    def open(self):
+        # Create the FIFO file if it doesn't exist.
+        if not os.path.exists(self.path):
+            os.mkfifo(self.path)
+
+    def write(self, jpeg):
+        if self.file is None:
+            try:
+                # Opening for writing without blocking fails while there is no consumer
+                fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as ex:
+                if ex.errno == errno.ENXIO:
+                    return
+                raise
+            # Blocking writes from here on, a frame must not be written partially
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            self.file = os.fdopen(fd, 'wb')
+        try:
+            self.file.write(jpeg)
+            self.file.flush()
+        except IOError:
+            # The consumer went away, reopen on a later frame
+            self.close()
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except IOError:
+                pass
+            self.file = None
+
+
+class _PreviewServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _PreviewHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        output = self.server.output
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        seq = 0
+        try:
+            while True:
+                seq, jpeg = output.wait_frame(seq)
+                if output.closed:
+                    break
+                if jpeg is None:
+                    continue
+                self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpOutput:
+    """ Serves the frames as an MJPEG stream, view with a browser at http://<device>:<port>/ """
+    def __init__(self, port=preview_port):
+        self.port = port
+        self.server = None
+        self.condition = Condition()
+        self.jpeg = None
+        self.seq = 0
+        self.closed = False
+
+    def open(self):
+        self.server = _PreviewServer(('0.0.0.0', self.port), _PreviewHandler)
+        self.server.output = self
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def write(self, jpeg):
+        # One copy of the frame is shared by all the clients
+        jpeg = bytes(jpeg)
+        with self.condition:
+            self.jpeg = jpeg
+            self.seq += 1
+            self.condition.notify_all()
+
+    def wait_frame(self, seq, timeout=idle_timeout):
+        """ Waits for a frame newer than seq, returns the (seq, jpeg) of the latest frame,
+            jpeg is None if no newer frame arrived within the timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq != seq or self.closed, timeout)
+            return self.seq, self.jpeg if self.seq != seq else None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,131 @@
+from threading import Thread, Event, Lock
+import queue
+import time
+
+import requests
+
+# Events arriving within batch_window seconds of the first pending event are merged into a
+# single submission sharing the first event's attachment. A batch is also flushed early
+# once it holds max_batch_events messages. A message already reported within
+# duplicate_cooldown seconds is dropped, which stops detections flapping around a
+# *_discontinue_max boundary from flooding the server.
+batch_window = 2.0
+max_batch_events = 5
+duplicate_cooldown = 30.0
+idle_poll_interval = 0.5
+# Separator between the merged messages of one submission
+message_separator = '; '
+
+
+class EventAggregator(Thread):
+    """ Worker thread that merges detection events and submits them to the SmartProctor
+        server in batches, keeping the network requests off the inference thread.
+    """
+    def __init__(self, exam_id, auth_cookie, server_url, window=batch_window,
+                 max_events=max_batch_events, cooldown=duplicate_cooldown):
+        super().__init__(name='EventAggregator', daemon=True)
+        self.exam_id = exam_id
+        self.auth_cookie = auth_cookie
+        self.server_url = server_url
+        self.window = window
+        self.max_events = max_events
+        self.cooldown = cooldown
+        self.event_queue = queue.Queue()
+        self.stop_request = Event()
+        self.lock = Lock()
+        self.last_reported = {}
+        self.pending = []
+        self.pending_attachment = None
+        self.pending_since = 0
+        # Keep-alive connection to the server, avoids a handshake per request
+        self.session = requests.Session()
+        self.session.headers['Cookie'] = auth_cookie
+        self.session.verify = False
+        # Statistics, used to measure the request reduction
+        self.events_received = 0
+        self.events_suppressed = 0
+        self.submissions = 0
+        self.requests_sent = 0
+
+    def accept(self, message):
+        """ Checks whether the message should be reported, False if the same message was
+            reported within the cooldown. Called before marking the frame so suppressed
+            events cost nothing.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.events_received += 1
+            last = self.last_reported.get(message)
+            if last is not None and now - last < self.cooldown:
+                self.events_suppressed += 1
+                return False
+            self.last_reported[message] = now
+            return True
+
+    def add(self, messages, attachment):
+        """ Queues the messages detected on one frame for submission
+            messages - List of event messages
+            attachment - JPEG bytes of the marked frame
+        """
+        self.event_queue.put((time.monotonic(), messages, attachment))
+
+    def run(self):
+        while not self.stop_request.isSet() or not self.event_queue.empty():
+            if self.pending:
+                timeout = max(self.window - (time.monotonic() - self.pending_since), 0)
+            else:
+                timeout = idle_poll_interval
+            try:
+                received, messages, attachment = self.event_queue.get(timeout=timeout)
+            except queue.Empty:
+                if self.pending:
+                    self.flush()
+                continue
+
+            if not self.pending:
+                self.pending_since = received
+                self.pending_attachment = attachment
+            self.pending.extend(messages)
+            if len(self.pending) >= self.max_events or time.monotonic() - self.pending_since >= self.window:
+                self.flush()
+        self.flush()
+
+    def flush(self):
+        """ Submits the pending events as one event with one attachment """
+        if not self.pending:
+            return
+        message = message_separator.join(self.pending)
+        attachment = self.pending_attachment
+        self.pending = []
+        self.pending_attachment = None
+        try:
+            self.__send_event_with_frame(message, attachment)
+        except:
+            pass
+        self.submissions += 1
+
+    def __upload_frame(self, frame):
+        try:
+            files = {'file': ('detection.jpg', frame, 'image/jpeg')}
+            self.requests_sent += 1
+            res = self.session.post(self.server_url + "/api/exam/UploadEventAttachment", files=files)
+            o = res.json()
+            return o['fileName']
+        except:
+            return None
+
+    def __send_event_with_frame(self, message, frame):
+        file_name = self.__upload_frame(frame)
+        self.requests_sent += 1
+        self.session.post(self.server_url + '/api/exam/SendEvent', json={
+            'examId': self.exam_id,
+            'type': 1,
+            'receipt': None,
+            'message': message,
+            'attachment': file_name
+        })
+
+    def join(self, timeout=None):
+        """ Stops the worker, pending events are flushed before it exits """
+        self.stop_request.set()
+        super().join(timeout)
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+""" Local stand-in for the SmartProctor server. It implements the endpoints used by the
+    edge computing client and counts the requests it receives, optionally adding latency
+    to simulate a congested network. Run with --measure to compare the number of requests
+    needed to report a synthetic detection sequence with and without event aggregation.
+"""
+import argparse
+import itertools
+import json
+import time
+from threading import Thread, Lock
+
+import requests
+from flask import Flask, jsonify, request
+
+from event_aggregator import EventAggregator
+
+
+class FakeServer:
+    """ Stand-in for the SmartProctor server API """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = Lock()
+        self.request_counts = {}
+        self.events = []
+        self.file_ids = itertools.count()
+        self.app = Flask("smartproctor-fake-server")
+        self.app.add_url_rule('/api/user/DeepLensLogin/<token>', 'login', self.login, methods=['GET'])
+        self.app.add_url_rule('/api/exam/ExamDetails/<exam_id>', 'exam_details', self.exam_details, methods=['GET'])
+        self.app.add_url_rule('/api/exam/UploadEventAttachment', 'upload', self.upload, methods=['POST'])
+        self.app.add_url_rule('/api/exam/SendEvent', 'send_event', self.send_event, methods=['POST'])
+        self.app.add_url_rule('/stats', 'stats', self.stats, methods=['GET'])
+        self.app.before_request(self.count_request)
+
+    def run_server(self, port=8000):
+        self.app.run(host='127.0.0.1', port=port, threaded=True)
+
+    def count_request(self):
+        if request.endpoint == 'stats':
+            return None
+        with self.lock:
+            self.request_counts[request.endpoint] = self.request_counts.get(request.endpoint, 0) + 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return None
+
+    def login(self, token):
+        response = jsonify({'code': 0})
+        response.headers['Set-Cookie'] = 'auth=' + token
+        return response
+
+    def exam_details(self, exam_id):
+        return jsonify({'id': int(exam_id), 'openBook': False})
+
+    def upload(self):
+        request.files['file'].read()
+        return jsonify({'fileName': '{}.jpg'.format(next(self.file_ids))})
+
+    def send_event(self):
+        with self.lock:
+            self.events.append(request.get_json())
+        return jsonify({'code': 0})
+
+    def stats(self):
+        with self.lock:
+            return jsonify({'requests': dict(self.request_counts),
+                            'total': sum(self.request_counts.values()),
+                            'events': len(self.events)})
+
+    def reset(self):
+        with self.lock:
+            self.request_counts = {}
+            self.events = []
+
+
+def synthetic_events(frames=600):
+    """ Generates the per-frame event messages of a synthetic exam: several rules tripping
+        on the same frames, and a cellphone detection flapping around its discontinue limit.
+    """
+    for i in range(frames):
+        messages = []
+        if i % 150 == 0:
+            messages += ['Exam taker left', 'multiple PC monitors/laptops detected']
+        if i % 150 == 1:
+            messages.append('book detected')
+        if i % 13 == 0:
+            messages.append('cellphone detected')
+        yield messages
+
+
+def measure(server, url, frame_interval, window, cooldown):
+    """ Reports the synthetic events directly and through the aggregator, returns the
+        request counts of both runs.
+    """
+    jpeg = b'\xff\xd8' + bytes(64 * 1024) + b'\xff\xd9'
+    results = {}
+
+    server.reset()
+    for messages in synthetic_events():
+        # The previous behaviour: one upload and one event per message
+        for message in messages:
+            file_name = requests.post(url + '/api/exam/UploadEventAttachment',
+                                      files={'file': ('detection.jpg', jpeg, 'image/jpeg')}).json()['fileName']
+            requests.post(url + '/api/exam/SendEvent', json={
+                'examId': 0, 'type': 1, 'receipt': None, 'message': message, 'attachment': file_name})
+    results['direct'] = requests.get(url + '/stats').json()
+
+    server.reset()
+    aggregator = EventAggregator(0, 'auth=measure', url, window=window, cooldown=cooldown)
+    aggregator.start()
+    for messages in synthetic_events():
+        messages = [message for message in messages if aggregator.accept(message)]
+        if len(messages) > 0:
+            aggregator.add(messages, jpeg)
+        time.sleep(frame_interval)
+    aggregator.join()
+    results['aggregated'] = requests.get(url + '/stats').json()
+    results['aggregated']['suppressed'] = aggregator.events_suppressed
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--measure', action='store_true', help='measure the request reduction and exit')
+    parser.add_argument('--frame-interval', type=float, default=0.01,
+                        help='seconds between synthetic frames when measuring')
+    parser.add_argument('--window', type=float, default=0.5, help='aggregation window when measuring')
+    parser.add_argument('--cooldown', type=float, default=1.0, help='duplicate cooldown when measuring')
+    args = parser.parse_args()
+
+    server = FakeServer(args.latency)
+    if not args.measure:
+        server.run_server(args.port)
+    else:
+        Thread(target=server.run_server, args=(args.port,), daemon=True).start()
+        time.sleep(1)
+        print(json.dumps(measure(server, 'http://127.0.0.1:{}'.format(args.port), args.frame_interval,
+                                 args.window, args.cooldown), indent=2))
@@ -1,39 +1,20 @@
 from threading import Thread, Event
+import logging
+import time
 import awscam
 import cv2
-import requests
-import json
-
-# The model used in the project is pre-trained with the COCO dataset
-# The labels in the COCO dataset can be found in
-# https://github.com/ActiveState/gococo/blob/master/labels.txt
-PERSON_LABEL = 1
-TV_LABEL = 72
-LAPTOP_LABEL = 73
-CELLPHONE_LABEL = 77
-BOOK_LABEL = 84
-
-# We have different threshold for different objects since the
-# model's accuracy varies with the object detected
-PERSON_THRESHOLD = 0.5
-TV_LAPTOP_THRESHOLD = 0.5
-CELLPHONE_THRESHOLD = 0.1
-BOOK_THRESHOLD = 0.4
-
-# Errors could occur during detection, but normally they will not occur in many continuous frames
-# We count the occurrences of different situations and detect whether the count exceeds a threshold
-# Also, the number of frames where the previously detected situation discontinues, when the count exceeds
-# a limit, we regard the previous situation as ended
-no_person_max = 10
-no_person_discontinue_max = 10
-multi_person_max = 20
-multi_person_discontinue_max = 20
-multi_monitor_max = 10
-multi_monitor_discontinue_max = 10
-cellphone_max = 3
-cellphone_discontinue_max = 10
-book_max = 3
-book_discontinue_max = 10
+
+import jpeg_encoder
+from event_aggregator import EventAggregator
+from detection_log import DetectionRecorder
+# The detection rules are kept in their own module so they can be evaluated offline
+from detection_rules import PERSON_LABEL, TV_LABEL, LAPTOP_LABEL, CELLPHONE_LABEL, BOOK_LABEL, \
+    PERSON_THRESHOLD, TV_LAPTOP_THRESHOLD, CELLPHONE_THRESHOLD, BOOK_THRESHOLD, \
+    no_person_max, no_person_discontinue_max, multi_person_max, multi_person_discontinue_max, \
+    multi_monitor_max, multi_monitor_discontinue_max, cellphone_max, cellphone_discontinue_max, \
+    book_max, book_discontinue_max
+
+logger = logging.getLogger('SmartProctor-cam')
 
 # The path to the optimized model, should be in /opt/awscam/artifacts/ when deployed
 model_path = '/opt/smartpoctor/Model/ssd_mobilenet_v2_coco.xml'
@@ -41,6 +22,14 @@ model_type = 'ssd'
 input_height = 300
 input_width = 300
 
+# Evidence frames are kept at full chroma resolution so small objects stay recognizable
+evidence_jpeg_quality = 95
+evidence_jpeg_subsampling = '444'
+
+# Every frame's raw detections are recorded here so disputed events can be audited,
+# set to None to disable recording
+detection_log_dir = '/opt/smartpoctor/detections'
+
 # Server address, should be changed to DNS name if deployed
 SERVER_ADDR = "10.28.140.146"
 SERVER_PROTOCOL = 'http'
@@ -50,7 +39,7 @@ SERVER_URL = SERVER_PROTOCOL + '://' + SERVER_ADDR
 class InferenceWorker(Thread):
     """ Worker thread that do the object detection inference."""
     def __init__(self, exam_id, allow_books, auth_cookie):
-        super().__init__()
+        super().__init__(name='InferenceWorker')
         self.no_person_count = 0
         self.no_person_discontinue = 0
         self.multi_person_count = 0
@@ -68,10 +57,19 @@ class InferenceWorker(Thread):
         self.auth_cookie = auth_cookie
         self.yscale = 0
         self.xscale = 0
+        self.encoder = jpeg_encoder.get_encoder()
+        self.events = EventAggregator(exam_id, auth_cookie, SERVER_URL)
+        self.recorder = None
 
     def run(self):
         # Load the optimized object detection model
         self.model = awscam.Model(model_path, {'GPU': 1})
+        self.events.start()
+        if detection_log_dir is not None:
+            try:
+                self.recorder = DetectionRecorder(detection_log_dir, 'exam{}'.format(self.exam_id))
+            except Exception as ex:
+                logger.error('Detection log disabled: {}'.format(ex))
         while not self.stop_request.isSet():
             res, frame = awscam.getLastFrame()
             if not res:
@@ -84,30 +82,28 @@ class InferenceWorker(Thread):
             self.yscale = float(frame.shape[0]) / float(input_height)
             self.xscale = float(frame.shape[1]) / float(input_width)
             self.process_result(result, frame)
-
-    def __upload_frame(self, frame):
+        self.__close_recorder()
+
+    def __close_recorder(self):
+        """ Closes the detection log, the log failing must never stop the detection """
+        recorder = self.recorder
+        self.recorder = None
+        if recorder is None:
+            return
         try:
-            files = {'file': ('detection.jpg', frame, 'image/jpeg')}
-            res = requests.post(SERVER_URL + "/api/exam/UploadEventAttachment", files=files,
-                                headers={'Cookie': self.auth_cookie}, verify=False)
-            o = res.json()
-            return o['fileName']
-        except:
-            return None
-
-    def __send_event_with_frame(self, message, frame):
-        file_name = self.__upload_frame(frame)
-        res = requests.post(SERVER_URL + '/api/exam/SendEvent', json={
-            'examId': self.exam_id,
-            'type': 1,
-            'receipt': None,
-            'message': message,
-            'attachment': file_name
-        }, headers={'Cookie': self.auth_cookie}, verify=False)
-
-    def mark_frame(self, frame, boxes, text):
-        cv2.putText(frame, text, (0, 60), cv2.FONT_HERSHEY_SIMPLEX, 2.5, (0, 0, 255), 6)
-        for box in boxes:
+            recorder.close()
+        except Exception as ex:
+            logger.error('Failed to close the detection log: {}'.format(ex))
+
+    def mark_frame(self, frame, events):
+        """ Draws the messages and bounding boxes of the events on the frame and encodes it
+            events - List of (message, boxes) tuples
+        """
+        position = 0
+        for text, boxes in events:
+            position += 60
+            cv2.putText(frame, text, (0, position), cv2.FONT_HERSHEY_SIMPLEX, 2.5, (0, 0, 255), 6)
+        for box in [box for _, boxes in events for box in boxes]:
             xmin, xmax, ymin, ymax, score = box
             # See https://docs.opencv.org/3.4.1/d6/d6e/group__imgproc__draw.html
             # for more information about the cv2.rectangle method.
@@ -122,13 +118,20 @@ class InferenceWorker(Thread):
             cv2.putText(frame, "{:.2f}%".format(score * 100),
                         (xmin, ymin - text_offset),
                         cv2.FONT_HERSHEY_SIMPLEX, 2.5, (0, 0, 255), 6)
-        return cv2.imencode('.jpg', frame)[1].tobytes()
+        return self.encoder.encode(frame, evidence_jpeg_quality, evidence_jpeg_subsampling)
 
     def process_result(self, result, frame):
         persons = []
         monitors = []
         cellphones = []
         books = []
+        if self.recorder is not None:
+            try:
+                self.recorder.record(result[model_type], self.xscale, self.yscale)
+            except Exception as ex:
+                # e.g. a full disk, keep detecting without the log
+                logger.error('Detection log disabled: {}'.format(ex))
+                self.__close_recorder()
         # Get the detected objects and probabilities
         for obj in result[model_type]:
             # Add bounding boxes to full resolution frame
@@ -196,26 +199,36 @@ class InferenceWorker(Thread):
             self.book_count = 0
             self.book_discontinue = 0
 
+        # Rules tripping on the same frame are reported together with one marked frame
+        events = []
         if self.no_person_count == no_person_max:
-            self.__send_event_with_frame('Exam taker left', self.mark_frame(frame, [], 'Exam taker left'))
+            events.append(('Exam taker left', []))
             self.no_person_count += 1
 
         if self.multi_person_count == multi_person_max:
-            self.__send_event_with_frame('multiple people detected', self.mark_frame(frame, persons, 'multiple people detected'))
+            events.append(('multiple people detected', persons))
             self.multi_person_count += 1
 
         if self.multi_monitor_count == multi_monitor_max:
-            self.__send_event_with_frame('multiple PC monitors/laptops detected', self.mark_frame(frame, monitors, 'multiple PC monitors/laptops detected'))
+            events.append(('multiple PC monitors/laptops detected', monitors))
             self.multi_monitor_count += 1
 
         if self.cellphone_count == cellphone_max:
-            self.__send_event_with_frame('cellphone detected', self.mark_frame(frame, cellphones, 'cellphone detected'))
+            events.append(('cellphone detected', cellphones))
             self.cellphone_count += 1
 
         if self.book_count == book_max:
-            self.__send_event_with_frame('book detected', self.mark_frame(frame, books, 'book detected'))
+            events.append(('book detected', books))
             self.book_count += 1
 
+        events = [event for event in events if self.events.accept(event[0])]
+        if len(events) > 0:
+            self.events.add([message for message, _ in events], self.mark_frame(frame, events))
+
     def join(self, timeout=None):
+        """ Stops the worker and its event aggregator, waiting at most timeout seconds for both """
         self.stop_request.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
         super().join(timeout)
+        if self.events.is_alive():
+            self.events.join(None if deadline is None else max(deadline - time.monotonic(), 0))
@@ -0,0 +1,242 @@
+import logging
+import time
+from threading import Lock
+
+import numpy as np
+import cv2
+
+# Optional faster encoders, the OpenCV encoder is always available
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+logger = logging.getLogger('SmartProctor-cam')
+
+# Encoder configurations. Set jpeg_backend to one of the backend names ('turbojpeg',
+# 'simplejpeg', 'opencv') to skip the self-benchmark and force a backend
+jpeg_backend = None
+default_quality = 95
+default_subsampling = '420'
+benchmark_rounds = 5
+benchmark_resolution = (858, 480)
+initial_buffer_size = 256 * 1024
+
+SUBSAMPLINGS = ('444', '422', '420')
+
+
+class JpegBuffer:
+    """ Reusable output buffer for encoded JPEG data, for backends that can encode into a
+        caller-provided buffer. The buffer only grows when the worst-case size of a frame
+        does not fit, so steady-state encoding does not allocate.
+    """
+    def __init__(self, size=initial_buffer_size):
+        self.data = bytearray(size)
+        self.length = 0
+
+    def reserve(self, size):
+        """ Makes room for size bytes, returns the writable buffer """
+        if size > len(self.data):
+            # Replace rather than resize, views handed out earlier may still be alive
+            self.data = bytearray(max(size, 2 * len(self.data)))
+        return self.data
+
+    def view(self):
+        """ Gets a view of the last encoded frame without copying """
+        return memoryview(self.data)[:self.length]
+
+
+class OpenCVBackend:
+    """ Encoder backend based on cv2.imencode """
+    name = 'opencv'
+    encodes_into = False
+
+    def __init__(self):
+        # The sampling factor flags only exist in OpenCV 4.5.5 and later
+        self.sampling_flag = getattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR', None)
+        self.sampling_values = {}
+        if self.sampling_flag is not None:
+            for subsampling in SUBSAMPLINGS:
+                self.sampling_values[subsampling] = getattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR_' + subsampling)
+
+    @staticmethod
+    def is_available():
+        return True
+
+    def encode(self, frame, quality, subsampling):
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        if self.sampling_flag is not None:
+            params += [self.sampling_flag, self.sampling_values[subsampling]]
+        ret, jpeg = cv2.imencode('.jpg', frame, params)
+        if not ret:
+            raise Exception('Failed to encode frame')
+        return jpeg
+
+
+class TurboJPEGBackend:
+    """ Encoder backend based on the PyTurboJPEG bindings of libjpeg-turbo """
+    name = 'turbojpeg'
+
+    def __init__(self):
+        self.jpeg = turbojpeg.TurboJPEG()
+        self.sampling_values = {
+            '444': turbojpeg.TJSAMP_444,
+            '422': turbojpeg.TJSAMP_422,
+            '420': turbojpeg.TJSAMP_420,
+        }
+        # Encoding into a caller-provided buffer (dst=) needs PyTurboJPEG 1.7 or later
+        self.encodes_into = hasattr(self.jpeg, 'buffer_size')
+
+    @staticmethod
+    def is_available():
+        if turbojpeg is None:
+            return False
+        try:
+            # Fails if the libjpeg-turbo shared library cannot be found
+            turbojpeg.TurboJPEG()
+            return True
+        except Exception:
+            return False
+
+    def encode(self, frame, quality, subsampling):
+        return self.jpeg.encode(np.ascontiguousarray(frame, dtype=np.uint8), quality=quality,
+                                pixel_format=turbojpeg.TJPF_BGR,
+                                jpeg_subsample=self.sampling_values[subsampling])
+
+    def encode_into(self, frame, quality, subsampling, out):
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        sampling = self.sampling_values[subsampling]
+        # Sized for the worst case, so the library never has to reallocate
+        dst = out.reserve(self.jpeg.buffer_size(frame, sampling))
+        encoded, out.length = self.jpeg.encode(frame, quality=quality, pixel_format=turbojpeg.TJPF_BGR,
+                                               jpeg_subsample=sampling, dst=dst)
+        if encoded is not dst:
+            raise Exception('Failed to encode frame into the buffer')
+        return out.view()
+
+
+class SimpleJPEGBackend:
+    """ Encoder backend based on simplejpeg, which bundles libjpeg-turbo """
+    name = 'simplejpeg'
+    encodes_into = False
+
+    @staticmethod
+    def is_available():
+        return simplejpeg is not None
+
+    def encode(self, frame, quality, subsampling):
+        return simplejpeg.encode_jpeg(np.ascontiguousarray(frame, dtype=np.uint8), quality=quality,
+                                      colorspace='BGR', colorsubsampling=subsampling)
+
+
+BACKENDS = (TurboJPEGBackend, SimpleJPEGBackend, OpenCVBackend)
+
+
+def available_backends():
+    """ Gets instances of all the backends usable on this device """
+    backends = []
+    for backend_class in BACKENDS:
+        if not backend_class.is_available():
+            continue
+        try:
+            backends.append(backend_class())
+        except Exception as ex:
+            logger.debug('JPEG backend {} unavailable: {}'.format(backend_class.name, ex))
+    return backends
+
+
+def benchmark_backend(backend, frame, rounds=benchmark_rounds):
+    """ Gets the best encoding time of the backend in seconds, None if it fails """
+    best = None
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            backend.encode(frame, default_quality, default_subsampling)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    except Exception as ex:
+        logger.debug('JPEG backend {} failed: {}'.format(backend.name, ex))
+        return None
+    return best
+
+
+def select_backend():
+    """ Selects the configured backend, or the fastest one with a short self-benchmark """
+    backends = available_backends()
+    if jpeg_backend is not None:
+        for backend in backends:
+            if backend.name == jpeg_backend:
+                return backend
+        logger.warning('JPEG backend {} unavailable, selecting automatically'.format(jpeg_backend))
+
+    if len(backends) == 1:
+        return backends[0]
+
+    # A gradient with noise, so the encoders do real entropy coding work
+    width, height = benchmark_resolution
+    frame = np.empty((height, width, 3), np.uint8)
+    frame[:] = np.linspace(0, 255, width, dtype=np.uint8)[np.newaxis, :, np.newaxis]
+    frame += np.random.RandomState(0).randint(0, 16, frame.shape, dtype=np.uint8)
+
+    fastest = None
+    fastest_time = None
+    for backend in backends:
+        elapsed = benchmark_backend(backend, frame)
+        if elapsed is None:
+            continue
+        logger.debug('JPEG backend {}: {:.2f} ms per frame'.format(backend.name, elapsed * 1000))
+        if fastest_time is None or elapsed < fastest_time:
+            fastest = backend
+            fastest_time = elapsed
+
+    return fastest if fastest is not None else OpenCVBackend()
+
+
+class JpegEncoder:
+    """ Encodes frames to JPEG with an interchangeable backend """
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else select_backend()
+        logger.info('Using JPEG backend ' + self.backend.name)
+
+    def encode(self, frame, quality=default_quality, subsampling=default_subsampling, out=None):
+        """ Encodes the frame, returns the JPEG bytes, or a memoryview valid until the next
+            encode into the same buffer if out is supplied.
+            frame - BGR image as numpy array
+            quality - JPEG quality from 1 to 100
+            subsampling - Chroma subsampling, one of '444', '422' or '420'
+            out - Optional JpegBuffer to encode into, backends that cannot encode into a
+                  buffer return a view of their own output instead
+        """
+        if subsampling not in SUBSAMPLINGS:
+            raise ValueError('Invalid chroma subsampling ' + str(subsampling))
+        if out is not None and self.backend.encodes_into:
+            return self.backend.encode_into(frame, quality, subsampling, out)
+        encoded = self.backend.encode(frame, quality, subsampling)
+        if out is not None:
+            # The backend allocated the output already, hand it out without copying it
+            return memoryview(encoded).cast('B')
+        return encoded.tobytes() if isinstance(encoded, np.ndarray) else bytes(encoded)
+
+
+_encoder = None
+_encoder_lock = Lock()
+
+
+def get_encoder():
+    """ Gets the shared encoder, selecting the backend on first use """
+    global _encoder
+    with _encoder_lock:
+        if _encoder is None:
+            _encoder = JpegEncoder()
+        return _encoder
+
+
+def encode(frame, quality=default_quality, subsampling=default_subsampling, out=None):
+    """ Encodes the frame with the shared encoder, see JpegEncoder.encode """
+    return get_encoder().encode(frame, quality, subsampling, out)
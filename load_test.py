@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+""" Load test of the SmartProctor edge computing client. SmartProctorApp runs in this process
+    with the camera, the model and the SmartProctor server faked locally, while MJPEG
+    viewers, status polling and stop/login cycles are driven against it. The results are
+    written as JSON, so runs of different versions can be compared.
+
+    python3 load_test.py --clients 4 --poll-rate 2 --cycle-rate 0.1 --duration 30 --output load.json
+"""
+import argparse
+import json
+import logging
+import subprocess
+import sys
+import time
+import types
+from threading import Thread, Event, Lock, current_thread
+
+import numpy as np
+import requests
+from werkzeug.serving import make_server
+
+# Fake camera and model configurations
+camera_resolution = (1920, 1080)
+model_latency = 0.06
+person_prob = 0.9
+cellphone_every = 50
+
+
+class FakeModel:
+    """ Stand-in for awscam.Model, sleeps for the inference latency of the DeepLens GPU and
+        returns a person, with a cellphone on every cellphone_every-th frame. Only the
+        inferences of the current worker count, those of a worker still running after it was
+        replaced are counted as overlapping.
+    """
+    inferences = 0
+    overlapping_inferences = 0
+    lock = Lock()
+    # Set by the load test, tells whether a worker thread is the current inference worker
+    is_current = staticmethod(lambda worker: True)
+
+    def __init__(self, path, options):
+        # The model is loaded by the inference worker thread
+        self.worker = current_thread()
+        self.inferences = 0
+
+    def doInference(self, frame):
+        time.sleep(model_latency)
+        self.inferences += 1
+        with FakeModel.lock:
+            if FakeModel.is_current(self.worker):
+                FakeModel.inferences += 1
+            else:
+                FakeModel.overlapping_inferences += 1
+        return self.inferences
+
+    def parseResult(self, model_type, inference):
+        result = [{'label': 1, 'prob': person_prob, 'xmin': 100, 'ymin': 50, 'xmax': 200, 'ymax': 290}]
+        if inference % cellphone_every < 5:
+            result.append({'label': 77, 'prob': 0.6, 'xmin': 20, 'ymin': 200, 'xmax': 60, 'ymax': 260})
+        return {model_type: result}
+
+
+def synthetic_frame(resolution, seed=0):
+    width, height = resolution
+    frame = np.empty((height, width, 3), np.uint8)
+    frame[:] = np.linspace(0, 255, width, dtype=np.uint8)[np.newaxis, :, np.newaxis]
+    frame += np.random.RandomState(seed).randint(0, 16, frame.shape, dtype=np.uint8)
+    return frame
+
+
+def install_fake_awscam():
+    """ Installs a fake awscam module, must be called before importing the client """
+    camera_frame = synthetic_frame(camera_resolution)
+    awscam = types.ModuleType('awscam')
+    awscam.Model = FakeModel
+    awscam.getLastFrame = lambda: (True, camera_frame.copy())
+    sys.modules['awscam'] = awscam
+
+
+def install_fakes(server_url, fake_system):
+    """ Points the client at the fake server and replaces the camera reader. Returns the
+        app module.
+    """
+    install_fake_awscam()
+    import app
+    import inference
+    import utils
+    import video_reader
+
+    class FakeVideoWorker(video_reader.VideoWorker):
+        """ Produces encoded synthetic frames at the stream framerate, like the camera """
+        def run(self):
+            frame = synthetic_frame(video_reader.stream_resolution, 1)
+            interval = 1.0 / video_reader.stream_framerate
+            next_frame = time.monotonic()
+            while not self.stop_request.isSet():
+                jpeg = self.encoder.encode(frame, video_reader.stream_jpeg_quality)
+                try:
+                    self.frame_queue.put_nowait(jpeg)
+                except video_reader.queue.Full:
+                    pass
+                next_frame += interval
+                self.stop_request.wait(max(next_frame - time.monotonic(), 0))
+
+    app.VideoWorker = FakeVideoWorker
+    app.SERVER_URL = server_url
+    inference.SERVER_URL = server_url
+    inference.detection_log_dir = None
+    if fake_system:
+        nmcli_output = 'Wired connection 1:802-3-ethernet:eth0\n'
+        utils.execute = lambda cmd, input_str=None, is_log=True, no_shlex=False: (0, nmcli_output)
+        utils.get_ip = lambda: '127.0.0.1'
+    return app
+
+
+def start_server(flask_app, port):
+    server = make_server('127.0.0.1', port, flask_app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return None
+    values = np.asarray(values)
+    return {
+        'count': len(values),
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p90': float(np.percentile(values, 90)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+    }
+
+
+class MjpegClient(Thread):
+    """ Reads the MJPEG stream and records the arrival time of every frame, reconnecting
+        when the stream ends
+    """
+    def __init__(self, url, stop_request):
+        super().__init__(daemon=True)
+        self.url = url
+        self.stop_request = stop_request
+        self.arrivals = []
+        self.bytes_received = 0
+        self.reconnects = 0
+        self.errors = 0
+
+    def run(self):
+        while not self.stop_request.isSet():
+            try:
+                with requests.get(self.url, stream=True, timeout=5) as res:
+                    buffered = b''
+                    for chunk in res.iter_content(chunk_size=16384):
+                        if self.stop_request.isSet():
+                            return
+                        self.bytes_received += len(chunk)
+                        buffered += chunk
+                        parts = buffered.split(b'--frame\r\n')
+                        # Every complete part before the last marker is a received frame
+                        now = time.monotonic()
+                        for part in parts[:-1]:
+                            if len(part) > 0:
+                                self.arrivals.append(now)
+                        buffered = parts[-1]
+            except requests.RequestException:
+                self.errors += 1
+                self.stop_request.wait(0.5)
+            self.reconnects += 1
+
+    def report(self, duration):
+        intervals = np.diff(self.arrivals) if len(self.arrivals) > 1 else []
+        return {
+            'frames': len(self.arrivals),
+            'fps': len(self.arrivals) / duration,
+            'bytes': self.bytes_received,
+            'reconnects': self.reconnects,
+            'errors': self.errors,
+            'interval': percentiles(intervals),
+            'jitter': float(np.std(intervals)) if len(intervals) > 0 else None,
+        }
+
+
+class RequestDriver(Thread):
+    """ Sends requests at a fixed rate, recording the latency of every request """
+    def __init__(self, name, rate, send, stop_request):
+        super().__init__(daemon=True)
+        self.name = name
+        self.interval = 1.0 / rate
+        self.send = send
+        self.stop_request = stop_request
+        self.latencies = {}
+        self.failures = {}
+
+    def record(self, endpoint, start, ok):
+        self.latencies.setdefault(endpoint, []).append(time.monotonic() - start)
+        if not ok:
+            self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+
+    def run(self):
+        next_request = time.monotonic()
+        while not self.stop_request.isSet():
+            self.send(self)
+            next_request += self.interval
+            self.stop_request.wait(max(next_request - time.monotonic(), 0))
+
+
+def timed_get(driver, url, endpoint):
+    start = time.monotonic()
+    try:
+        ok = requests.get(url + endpoint, timeout=10).ok
+    except requests.RequestException:
+        ok = False
+    driver.record(endpoint, start, ok)
+
+
+def restart_exam_cycle(driver, url):
+    """ Stops the running exam and starts it again, so the exam keeps running between cycles """
+    timed_get(driver, url, '/stop_exam')
+    start = time.monotonic()
+    try:
+        ok = requests.post(url + '/login_and_start_exam', json={'token': 'load', 'examId': 1},
+                           timeout=10).json()['success']
+    except (requests.RequestException, ValueError):
+        ok = False
+    driver.record('/login_and_start_exam', start, ok)
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_load_test(args):
+    from fake_server import FakeServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    fake_server = FakeServer(args.server_latency)
+    # Served like the client under test, Flask's run would print its banner to stdout
+    fake_http_server = start_server(fake_server.app, args.server_port)
+    server_url = 'http://127.0.0.1:{}'.format(args.server_port)
+
+    app = install_fakes(server_url, not args.real_system)
+    import video_reader
+    smartproctor = app.SmartProctorApp()
+    FakeModel.is_current = staticmethod(lambda worker: worker is smartproctor.inference_worker)
+    http_server = start_server(smartproctor.app, args.port)
+    url = 'http://127.0.0.1:{}'.format(args.port)
+    time.sleep(0.5)
+
+    # Start an exam, so inference runs during the whole test
+    res = requests.post(url + '/login_and_start_exam', json={'token': 'load', 'examId': 1}).json()
+    if not res['success']:
+        raise Exception('Failed to start the exam')
+    time.sleep(args.warmup)
+
+    stop_request = Event()
+    clients = [MjpegClient(url + '/video_stream', stop_request) for _ in range(args.clients)]
+    drivers = []
+    if args.poll_rate > 0:
+        for endpoint in ('/network_status', '/sn'):
+            drivers.append(RequestDriver(endpoint, args.poll_rate,
+                                         lambda driver, endpoint=endpoint: timed_get(driver, url, endpoint),
+                                         stop_request))
+    if args.cycle_rate > 0:
+        drivers.append(RequestDriver('cycle', args.cycle_rate,
+                                     lambda driver: restart_exam_cycle(driver, url), stop_request))
+
+    inferences_before = FakeModel.inferences
+    overlapping_before = FakeModel.overlapping_inferences
+    start = time.monotonic()
+    for thread in clients + drivers:
+        thread.start()
+    time.sleep(args.duration)
+    stop_request.set()
+    duration = time.monotonic() - start
+    inferences = FakeModel.inferences - inferences_before
+    overlapping = FakeModel.overlapping_inferences - overlapping_before
+    for thread in clients + drivers:
+        thread.join(5)
+
+    latencies = {}
+    failures = {}
+    for driver in drivers:
+        for endpoint, values in driver.latencies.items():
+            latencies.setdefault(endpoint, []).extend(values)
+        for endpoint, count in driver.failures.items():
+            failures[endpoint] = failures.get(endpoint, 0) + count
+
+    requests.get(url + '/stop_exam')
+    http_server.shutdown()
+    server_requests = requests.get(server_url + '/stats').json()
+    fake_http_server.shutdown()
+    return {
+        'version': git_version(),
+        'time': time.time(),
+        'config': vars(args),
+        'stream_framerate': video_reader.stream_framerate,
+        'duration': duration,
+        'inference_fps': inferences / duration,
+        'inference_fps_unloaded': 1.0 / model_latency,
+        'overlapping_inferences': overlapping,
+        'clients': [client.report(duration) for client in clients],
+        'endpoints': dict((endpoint, percentiles(values)) for endpoint, values in latencies.items()),
+        'failures': failures,
+        'server_requests': server_requests,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=4, help='number of MJPEG viewers')
+    parser.add_argument('--poll-rate', type=float, default=2.0,
+                        help='requests per second to /network_status and /sn each, 0 to disable')
+    parser.add_argument('--cycle-rate', type=float, default=0.0,
+                        help='stop/login cycles per second, 0 to disable')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of load')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds between starting the exam and the load')
+    parser.add_argument('--port', type=int, default=18080, help='port of the client under test')
+    parser.add_argument('--server-port', type=int, default=18000, help='port of the fake SmartProctor server')
+    parser.add_argument('--server-latency', type=float, default=0.0, help='latency of the fake server')
+    parser.add_argument('--real-system', action='store_true',
+                        help='use the real nmcli and network calls, on the DeepLens')
+    parser.add_argument('--output', help='write the results as JSON to this file, stdout otherwise')
+    args = parser.parse_args()
+
+    results = run_load_test(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
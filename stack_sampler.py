@@ -0,0 +1,63 @@
+import math
+import os
+import sys
+import threading
+import time
+
+# Limits of a profiling session, keeping the overhead on the device bounded
+max_duration = 30.0
+min_interval = 0.005
+max_depth = 64
+
+
+class SamplerBusy(Exception):
+    """ Raised when a profiling session is already running """
+    pass
+
+
+_session_lock = threading.Lock()
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def sample_stacks(duration, interval):
+    """ Samples the stacks of all the other threads every interval seconds for duration
+        seconds, returns a dictionary of collapsed stacks to the number of samples.
+        Only one session runs at a time, SamplerBusy is raised otherwise.
+    """
+    if not math.isfinite(duration) or not math.isfinite(interval):
+        raise ValueError('The duration and the interval must be finite')
+    duration = min(max(duration, 0), max_duration)
+    # The session never runs longer than the duration, whatever the interval
+    interval = min(max(interval, min_interval), max(duration, min_interval))
+    if not _session_lock.acquire(blocking=False):
+        raise SamplerBusy()
+    try:
+        own_ident = threading.get_ident()
+        samples = {}
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < max_depth:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-{}'.format(ident)))
+                key = ';'.join(reversed(stack))
+                samples[key] = samples.get(key, 0) + 1
+            time.sleep(max(min(interval, end - time.monotonic()), 0))
+        return samples
+    finally:
+        _session_lock.release()
+
+
+def collapse(samples):
+    """ Formats the samples in the collapsed stack format read by flamegraph.pl and speedscope """
+    lines = ['{} {}'.format(stack, count) for stack, count in sorted(samples.items(), key=lambda item: -item[1])]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+""" Evaluates the cheating detection rules over recorded detections for a grid of thresholds
+    and window settings, so the constants in detection_rules.py can be tuned offline.
+
+    Sweep two cellphone settings over the detection logs of an exam:
+    python3 threshold_sweep.py /opt/smartpoctor/detections --set cellphone_threshold=0.1,0.2,0.3 \
+        --set cellphone_max=3,5 --output sweep.json
+    Run the model once over a recorded video first (on the DeepLens only):
+    python3 threshold_sweep.py --video exam.mp4 --log-dir /tmp/exam-detections ...
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+import detection_rules
+from detection_log import DetectionLog, DetectionRecorder, NO_DETECTION_LABEL, log_prefixes
+
+# Sessions evaluated by each worker process, see init_worker
+_sessions = []
+_count_caches = []
+
+
+def find_recordings(paths):
+    """ Gets the (path, prefix) of every recording, a log directory holds one recording per
+        log prefix, e.g. one per exam, which must be evaluated separately
+    """
+    recordings = []
+    for path in paths:
+        if os.path.isdir(path):
+            recordings += [(path, prefix) for prefix in log_prefixes(path)]
+        else:
+            recordings.append((path, '*'))
+    return recordings
+
+
+def load_sessions(path, prefix):
+    """ Loads the sessions of a recording as (frame_ids, labels, probs, n_frames,
+        frame_timestamps) tuples. Every recorder, e.g. every login to the exam, starts a
+        session with its frame counter at 0, and the live worker starts it with fresh rule
+        counters, so the sessions are evaluated separately. The memory-mapped log is
+        filtered part by part, only the detections and frame timestamps are copied.
+    """
+    sessions = []
+    pieces = []
+    n_frames = 0
+    last_frame = None
+    for part in DetectionLog(path, prefix).parts:
+        frames = part['frame']
+        new_frame = np.empty(len(part), bool)
+        new_frame[0] = last_frame is None or frames[0] != last_frame
+        new_frame[1:] = frames[1:] != frames[:-1]
+        last_frame = frames[-1]
+        new_session = new_frame & (frames == 0)
+        cuts = np.flatnonzero(new_session)
+        for lo, hi in zip(np.concatenate(([0], cuts)), np.concatenate((cuts, [len(part)]))):
+            if new_session[lo] and len(pieces) > 0:
+                sessions.append(join_pieces(pieces, n_frames))
+                pieces = []
+                n_frames = 0
+            if lo == hi:
+                continue
+            records = part[lo:hi]
+            # Renumber the frames from 0, the first frame may continue from the previous part
+            frame_ids = np.cumsum(new_frame[lo:hi]) - 1 + n_frames
+            detections = records['label'] != NO_DETECTION_LABEL
+            pieces.append((frame_ids[detections], records['label'][detections], records['prob'][detections],
+                           records['timestamp'][new_frame[lo:hi]]))
+            n_frames += int(np.count_nonzero(new_frame[lo:hi]))
+    if len(pieces) > 0:
+        sessions.append(join_pieces(pieces, n_frames))
+    return sessions
+
+
+def join_pieces(pieces, n_frames):
+    frame_ids, labels, probs, timestamps = [np.concatenate(arrays) for arrays in zip(*pieces)]
+    return frame_ids, labels, probs, n_frames, timestamps
+
+
+def init_worker(sessions):
+    """ Process pool initializer. The sessions are loaded once by the parent, forked workers
+        share them rather than each copying the logs.
+    """
+    global _sessions, _count_caches
+    _sessions = sessions
+    _count_caches = [{} for _ in sessions]
+
+
+def evaluate_config(job):
+    """ Evaluates the rules with one parameter set over all the loaded sessions """
+    index, params, with_timeline = job
+    counts = dict((name, 0) for name, _, _, _, _ in detection_rules.RULES)
+    timeline = []
+    messages = dict((name, message) for name, message, _, _, _ in detection_rules.RULES)
+    for session, (frame_ids, labels, probs, n_frames, timestamps) in enumerate(_sessions):
+        fired = detection_rules.evaluate_rules(frame_ids, labels, probs, n_frames, params,
+                                               _count_caches[session])
+        for name, frames in fired.items():
+            counts[name] += len(frames)
+            if with_timeline:
+                timeline += [{'session': session, 'rule': name, 'message': messages[name],
+                              'frame': int(frame), 'timestamp': float(timestamps[frame])} for frame in frames]
+    timeline.sort(key=lambda event: (event['session'], event['timestamp']))
+    result = {'params': params, 'counts': counts, 'total': sum(counts.values())}
+    if with_timeline:
+        result['events'] = timeline
+    return index, result
+
+
+def parse_value(name, value):
+    if name == 'allow_books':
+        return value.lower() in ('1', 'true', 'yes')
+    if name.endswith('_max'):
+        return int(value)
+    return float(value)
+
+
+def parse_grid(settings):
+    """ Parses name=value1,value2 settings into a list of parameter sets """
+    defaults = detection_rules.default_params()
+    names = []
+    values = []
+    for setting in settings:
+        name, _, value_list = setting.partition('=')
+        if name not in defaults:
+            raise ValueError('Unknown parameter {}, expected one of {}'.format(name, ', '.join(sorted(defaults))))
+        names.append(name)
+        values.append([parse_value(name, value) for value in value_list.split(',')])
+        # The rule counters never fire with limits below 1, which evaluate_rule does not model
+        if name.endswith('_max') and min(values[-1]) < 1:
+            raise ValueError('{} must be at least 1'.format(name))
+    grid = []
+    for combination in itertools.product(*values):
+        params = dict(defaults)
+        params.update(zip(names, combination))
+        grid.append(params)
+    return grid, names
+
+
+def record_video(video_path, log_dir):
+    """ Runs the model once over a recorded video, writing the detections to a log. This
+        requires the model and the awscam module, so it only works on the DeepLens.
+    """
+    import awscam
+    import cv2
+    from inference import model_path, model_type, input_height, input_width
+
+    model = awscam.Model(model_path, {'GPU': 1})
+    recorder = DetectionRecorder(log_dir, os.path.splitext(os.path.basename(video_path))[0])
+    capture = cv2.VideoCapture(video_path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 15.0
+    index = 0
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        result = model.parseResult(model_type, model.doInference(cv2.resize(frame, (input_height, input_width))))
+        yscale = float(frame.shape[0]) / float(input_height)
+        xscale = float(frame.shape[1]) / float(input_width)
+        recorder.record(result[model_type], xscale, yscale, timestamp=index / fps)
+        index += 1
+    capture.release()
+    recorder.close()
+    print('Recorded {} frames to {}'.format(index, log_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logs', nargs='*', help='detection log files, or directories holding one recording per log prefix')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=V1,V2',
+                        help='parameter values to sweep, repeat for a grid over several parameters')
+    parser.add_argument('--video', action='append', default=[], help='recorded video to run the model over first')
+    parser.add_argument('--log-dir', default='/tmp/sweep-detections', help='where to record the videos to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--timeline', action='store_true', help='include the event timelines in the output')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    logs = list(args.logs)
+    for video in args.video:
+        video_log_dir = os.path.join(args.log_dir, os.path.splitext(os.path.basename(video))[0])
+        record_video(video, video_log_dir)
+        logs.append(video_log_dir)
+    if len(logs) == 0:
+        parser.error('no detection logs or videos given')
+
+    recordings = find_recordings(logs)
+    if len(recordings) == 0:
+        parser.error('no detection logs found')
+    try:
+        grid, swept = parse_grid(args.set)
+    except ValueError as ex:
+        parser.error(str(ex))
+    start = time.time()
+    sessions = []
+    session_names = []
+    for path, prefix in recordings:
+        loaded = load_sessions(path, prefix)
+        sessions += loaded
+        session_names += [{'path': path, 'prefix': prefix, 'session': index} for index in range(len(loaded))]
+    results = [None] * len(grid)
+    jobs = [(index, params, args.timeline) for index, params in enumerate(grid)]
+    with Pool(max(1, min(args.workers, len(grid))), init_worker, (sessions,)) as pool:
+        for index, result in pool.imap_unordered(evaluate_config, jobs, chunksize=max(1, len(jobs) // 64)):
+            results[index] = result
+    elapsed = time.time() - start
+
+    rule_names = [name for name, _, _, _, _ in detection_rules.RULES]
+    print('\t'.join(swept + rule_names + ['total']))
+    for result in results:
+        print('\t'.join([str(result['params'][name]) for name in swept] +
+                        [str(result['counts'][name]) for name in rule_names] + [str(result['total'])]))
+    print('Evaluated {} configurations over {} sessions of {} recordings in {:.2f} s'.format(
+        len(grid), len(sessions), len(recordings), elapsed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'logs': logs, 'recordings': recordings, 'sessions': session_names, 'swept': swept, 'results': results}, f, indent=2)
@@ -1,12 +1,18 @@
+import atexit
 import os
 import stat
+import time
+import logging
 
 import numpy as np
-from threading import Thread, Event
+from threading import Thread, Event, Lock, Timer
 import queue
 import awscam
 import cv2
 
+import jpeg_encoder
+import utils
+
 # Streaming configurations, inspired by /opt/awscam/awsmedia/config.json
 # on AWS DeepLens, which is used for AWS DeepLens' video streaming server
 video_release_timeout = 0.1
@@ -17,21 +23,105 @@ stream_timeout = 1
 stream_framerate = 15
 original_framerate = 24
 stream_resolution = (858, 480)
+stream_jpeg_quality = 95
 original_resolution = (1920, 1080)
+# Seconds to wait after the last video worker stops before restoring the original camera
+# properties, so quickly restarting the stream does not switch the camera back and forth
+camera_restore_delay = 5.0
 
 MXUVC_BIN = "/opt/awscam/camera/installed/bin/mxuvc"
 
 
-def set_camera_prop(fps, resolution):
-    """ Helper method that sets the cameras frame rate and resolution. Used
-        predominantly by the h264 video stream, should not be called if user
-        is using KVS.
-        fps - Desired framerate
-        resolution - Tuple of (width, height) for desired resolution, accepted
-                     values in RESOLUTION.
+logger = logging.getLogger('SmartProctor-cam')
+
+
+class CameraControl:
+    """ Controls the camera properties with mxuvc. The current properties are tracked so
+        mxuvc is only called when a property actually changes.
     """
-    os.system("{} --ch 1 framerate {}".format(MXUVC_BIN, fps))
-    os.system("{} --ch 1 resolution {} {}".format(MXUVC_BIN, resolution[0], resolution[1]))
+    def __init__(self):
+        self.lock = Lock()
+        # None while the camera state is unknown, e.g. after mxuvc failed
+        self.framerate = None
+        self.resolution = None
+        self.users = 0
+        self.restore_timer = None
+        # Duration in seconds of the last call of each mxuvc command
+        self.timings = {}
+
+    def __mxuvc(self, prop, *values):
+        cmd = [MXUVC_BIN, '--ch', '1', prop] + [str(value) for value in values]
+        start = time.monotonic()
+        try:
+            ret = utils.execute(cmd, is_log=False, no_shlex=True)[0]
+        except OSError as ex:
+            logger.warning('mxuvc {} failed: {}'.format(prop, ex))
+            return False
+        elapsed = time.monotonic() - start
+        self.timings[prop] = elapsed
+        logger.info('mxuvc {} {} took {:.3f} s'.format(prop, ' '.join(cmd[4:]), elapsed))
+        return ret == 0
+
+    def set_props(self, fps, resolution):
+        """ Sets the cameras frame rate and resolution. Used predominantly by the h264
+            video stream, should not be called if user is using KVS.
+            fps - Desired framerate
+            resolution - Tuple of (width, height) for desired resolution, accepted
+                         values in RESOLUTION.
+        """
+        with self.lock:
+            self.__set_props(fps, resolution)
+
+    def __set_props(self, fps, resolution):
+        resolution = tuple(resolution)
+        if self.framerate != fps:
+            self.framerate = fps if self.__mxuvc('framerate', fps) else None
+        if self.resolution != resolution:
+            self.resolution = resolution if self.__mxuvc('resolution', *resolution) else None
+
+    def acquire(self, fps, resolution):
+        """ Sets the properties for a video worker, cancelling a pending restore """
+        with self.lock:
+            self.users += 1
+            if self.restore_timer is not None:
+                self.restore_timer.cancel()
+                self.restore_timer = None
+            self.__set_props(fps, resolution)
+
+    def release(self):
+        """ Restores the original properties once no video worker has used the camera
+            for camera_restore_delay seconds
+        """
+        with self.lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            self.restore_timer = Timer(camera_restore_delay, self.__restore)
+            self.restore_timer.daemon = True
+            self.restore_timer.start()
+
+    def __restore(self):
+        with self.lock:
+            if self.users > 0:
+                return
+            self.restore_timer = None
+            self.__set_props(original_framerate, original_resolution)
+
+    def restore_pending(self):
+        """ Restores the original properties right away if a restore is still pending, the
+            restore timer is a daemon thread and does not run once the process exits
+        """
+        with self.lock:
+            if self.restore_timer is None:
+                return
+            self.restore_timer.cancel()
+            self.restore_timer = None
+            if self.users == 0:
+                self.__set_props(original_framerate, original_resolution)
+
+
+camera = CameraControl()
+atexit.register(camera.restore_pending)
 
 
 class VideoWorker(Thread):
@@ -39,21 +129,29 @@ class VideoWorker(Thread):
         Inspired by /opt/awscam/awsmedia/video_server.py on AWS DeepLens.
     """
     def __init__(self):
-        super().__init__(daemon=True)
+        super().__init__(name='VideoWorker', daemon=True)
         self.frame_queue = queue.Queue(maxsize=max_buffer_size)
         self.stop_request = Event()
         self.tracks = set()
+        self.encoder = jpeg_encoder.get_encoder()
 
     def run(self):
-        set_camera_prop(stream_framerate, stream_resolution)
+        camera.acquire(stream_framerate, stream_resolution)
+        try:
+            self.__read_frames()
+        finally:
+            camera.release()
+
+    def __read_frames(self):
         while not stat.S_ISFIFO(os.stat(live_stream_src).st_mode):
-            continue
+            if self.stop_request.wait(video_release_timeout):
+                return
         video_capture = cv2.VideoCapture(live_stream_src)
         while not self.stop_request.isSet():
             ret, frame = video_capture.read()
             try:
                 if ret:
-                    jpeg = cv2.imencode('.jpg', frame)[1]
+                    jpeg = self.encoder.encode(frame, stream_jpeg_quality)
                     self.frame_queue.put_nowait(jpeg)
             except queue.Full:
                 continue
@@ -62,13 +160,14 @@ class VideoWorker(Thread):
     def get_frame(self):
         """ Gets one JPEG video frame, a pure-black frame if the queue is empty """
         try:
-            return self.frame_queue.get(timeout=stream_timeout).tobytes()
+            return self.frame_queue.get(timeout=stream_timeout)
         except queue.Empty:
-            black_canvas = 0 * np.ones([stream_resolution[0], stream_resolution[1], 3])
-            jpeg = cv2.imencode('.jpg', cv2.resize(black_canvas, stream_resolution))[1]
-            return jpeg.tobytes()
+            black_canvas = np.zeros([stream_resolution[1], stream_resolution[0], 3], np.uint8)
+            return self.encoder.encode(black_canvas, stream_jpeg_quality)
 
     def join(self, timeout=None):
+        """ Stops the worker, the camera properties are restored by the worker thread
+            after it released the camera, see CameraControl.release
+        """
         self.stop_request.set()
-        set_camera_prop(original_framerate, original_resolution)
-        super().join(video_release_timeout)
+        super().join(video_release_timeout if timeout is None else timeout)